@@ -1,14 +1,18 @@
-import json
-from typing import List
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional
 import uuid
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
 from google.api_core import exceptions as google_exceptions
-from fastapi import APIRouter, HTTPException, status, Depends, Response
+from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi.responses import ORJSONResponse
 
 from db.session import get_db_pool
 from models.chat import (
-    ChatMessage,
     MessageRequest,
     StartChatSessionRequest,
     StartChatSessionResponse,
@@ -16,19 +20,98 @@ from models.chat import (
     UserSessionInfo,
 )
 from models.persona import Persona
-from core.config import GEMINI_MODEL_VERSION, MAX_CONVERSATION_TOKENS, DEFAULT_POLLY_VOICE_ID
-from services.aws import get_or_create_audio_url, generate_audio_filename, get_presigned_url
+from core.config import GEMINI_MODEL_VERSION, MAX_CONVERSATION_TOKENS, DEFAULT_POLLY_VOICE_ID, SESSION_HISTORY_CACHE_SIZE
+from services.aws import get_or_create_audio_url, generate_audio_filename, get_presigned_urls
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
-def construct_system_prompt_from_persona(persona: Persona) -> str:
-    """Constructs a detailed system prompt for the AI to act as an expert voice director."""
-    if not persona:
-        return None
-    
-    p = dict(persona)
-    
-    ssml_instructions = """
+# Last history this process wrote per session, tagged with the row's xmin (its row
+# version). The message SELECT only ships the jsonb blob when xmin no longer matches,
+# i.e. the row changed elsewhere or our commit didn't land, so entries are never stale.
+_history_cache: "OrderedDict[uuid.UUID, tuple[int, list]]" = OrderedDict()
+
+# bot_version -> monotonic deadline. Model names Gemini answered NotFound for are
+# rejected locally for a while instead of spending a model round trip each time.
+UNKNOWN_BOT_VERSION_TTL_SECONDS = 300
+UNKNOWN_BOT_VERSION_CACHE_SIZE = 256
+_unknown_bot_versions: "OrderedDict[str, float]" = OrderedDict()
+
+# --- SQL ---
+# Kept as module-level constants so the queries are named and read in one place.
+# (asyncpg caches prepared statements by query text, so this doesn't change performance.)
+_INSERT_SESSION_SQL = "INSERT INTO chat_sessions (user_id, persona_id, bot_version) VALUES ($1, $2, $3) RETURNING *"
+
+_SELECT_HISTORY_SQL = """
+SELECT s.session_id, s.session_name, s.persona_id, s.bot_version, s.history, p.voice_id
+FROM chat_sessions s LEFT JOIN personas p ON p.prompt_id = s.persona_id
+WHERE s.session_id = $1
+"""
+
+# Only the session/persona columns handle_chat_message uses. The history length is
+# computed by Postgres so the first-message check doesn't depend on the decoded blob,
+# and session_name is skipped on the first message, where it gets replaced anyway.
+# $2 is the xmin of the cached history (or NULL); history is only sent when it differs.
+# row_xmin is the version the turn was built on; the final write is guarded by it.
+_MESSAGE_SESSION_COLUMNS = """
+CASE WHEN jsonb_array_length(s.history) > 0 THEN s.session_name END AS session_name,
+s.persona_id, s.bot_version, s.history_tokens, s.xmin AS row_xmin,
+COALESCE(s.xmin = $2, false) AS history_cached,
+CASE WHEN s.xmin = $2 THEN NULL ELSE s.history END AS history,
+COALESCE(jsonb_array_length(s.history), 0) AS history_length,
+p.prompt_id AS persona_prompt_id, p.voice_id, p.role_name, p.goal, p.personality
+"""
+
+# $3/$4 are the request's persona_id/bot_version overrides (or NULL). They are applied
+# to the row in memory only; the history write after a successful Gemini call persists
+# them, so a failed turn (e.g. an unknown bot_version) leaves the session unchanged.
+_SELECT_MESSAGE_SESSION_SQL = f"""
+SELECT {_MESSAGE_SESSION_COLUMNS}
+FROM (
+    SELECT session_name, history, history_tokens, xmin,
+           COALESCE($3, persona_id) AS persona_id, COALESCE($4, bot_version) AS bot_version
+    FROM chat_sessions
+    WHERE session_id = $1
+) s LEFT JOIN personas p ON p.prompt_id = s.persona_id
+"""
+
+# Appends the new messages ($1) in place instead of resending the whole history, after
+# dropping the $2 oldest stored messages that no longer fit the token budget.
+_APPEND_HISTORY_EXPR = """
+CASE WHEN $2 = 0 THEN COALESCE(history, '[]'::jsonb)
+     ELSE jsonb_path_query_array(history, '$[$drop to last]', jsonb_build_object('drop', $2::int))
+END || $1::jsonb
+"""
+
+# No lock is held during the Gemini call, so the write only applies if the row is still
+# the version the turn was read from (xmin); otherwise nothing is returned.
+# The persona_id/bot_version overrides used for the turn are saved with it.
+_UPDATE_HISTORY_SQL = f"""
+UPDATE chat_sessions SET history = {_APPEND_HISTORY_EXPR}, history_tokens = $3,
+    persona_id = COALESCE($6, persona_id), bot_version = COALESCE($7, bot_version)
+WHERE session_id = $4 AND xmin = $5
+RETURNING xmin
+"""
+
+_UPDATE_HISTORY_AND_NAME_SQL = f"""
+UPDATE chat_sessions SET history = {_APPEND_HISTORY_EXPR}, history_tokens = $3, session_name = $4,
+    persona_id = COALESCE($7, persona_id), bot_version = COALESCE($8, bot_version)
+WHERE session_id = $5 AND xmin = $6
+RETURNING xmin
+"""
+
+# Fallback when another turn on the same session landed first: the trim and token
+# counts were computed against the old row, so just append the messages and let the
+# next turn re-estimate the token counts.
+_APPEND_HISTORY_CONFLICT_SQL = """
+UPDATE chat_sessions SET history = COALESCE(history, '[]'::jsonb) || $1::jsonb, history_tokens = '{}',
+    persona_id = COALESCE($3, persona_id), bot_version = COALESCE($4, bot_version)
+WHERE session_id = $2
+RETURNING xmin
+"""
+
+# --- SYSTEM PROMPT ---
+_SSML_INSTRUCTIONS = """
 ### SSML Generation Mandate
 You are an expert SSML generator for Amazon Polly's Neural Engine. Your goal is "Human-Like Naturalness", avoiding robotic artifacts at all costs.
 
@@ -58,21 +141,74 @@ Oh no! I forgot the keys. Wait... let me check my bag.
 
 [SSML_TEXT]
 <speak><amazon:effect name="drc"><prosody rate="fast">Oh no!</prosody> I forgot the keys. <break strength="medium"/> Wait... <prosody rate="105%">let me check my bag.</prosody></amazon:effect></speak>
-"""
+""".strip()
 
-    prompt_parts = [
-        "# YOUR ROLE AND GOAL",
-        f"- Role: You are {p.get('role_name', 'an AI assistant')}.",
-        f"- Goal: {p.get('goal', 'To assist the user.')}",
-        "",
-        "# CORE CHARACTERISTICS",
-        f"- Personality: {p.get('personality', 'Standard AI personality.')}",
-        "",
-        "# RESPONSE FORMAT AND SSML RULES",
-        ssml_instructions.strip(),
-    ]
+# Static scaffolding of the persona prompt; only the persona fields vary per call.
+_PERSONA_PROMPT_TEMPLATE = """\
+# YOUR ROLE AND GOAL
+- Role: You are {role_name}.
+- Goal: {goal}
+
+# CORE CHARACTERISTICS
+- Personality: {personality}
+
+# RESPONSE FORMAT AND SSML RULES
+{ssml_instructions}"""
+
+def _cache_history(session_id: uuid.UUID, xmin: int, history: list) -> None:
+    """Remembers the history just written for a session, evicting the least recent."""
+    if SESSION_HISTORY_CACHE_SIZE <= 0:
+        return
+    _history_cache[session_id] = (xmin, history)
+    _history_cache.move_to_end(session_id)
+    if len(_history_cache) > SESSION_HISTORY_CACHE_SIZE:
+        _history_cache.popitem(last=False)
+
+def _is_unknown_bot_version(bot_version: str) -> bool:
+    deadline = _unknown_bot_versions.get(bot_version)
+    if deadline is None:
+        return False
+    if deadline > time.monotonic():
+        return True
+    del _unknown_bot_versions[bot_version]
+    return False
+
+def _remember_unknown_bot_version(bot_version: str) -> None:
+    _unknown_bot_versions[bot_version] = time.monotonic() + UNKNOWN_BOT_VERSION_TTL_SECONDS
+    _unknown_bot_versions.move_to_end(bot_version)
+    if len(_unknown_bot_versions) > UNKNOWN_BOT_VERSION_CACHE_SIZE:
+        _unknown_bot_versions.popitem(last=False)
+
+def estimate_tokens(text: str) -> int:
+    """Rough local token count (~4 characters per token) used for history trimming."""
+    return len(text) // 4 + 1
+
+@lru_cache(maxsize=256)
+def get_generative_model(model_version: str, system_instruction: Optional[str]) -> genai.GenerativeModel:
+    """Returns a shared GenerativeModel for the given version and system prompt."""
+    return genai.GenerativeModel(model_version, system_instruction=system_instruction)
+
+def construct_system_prompt_from_persona(persona: Persona) -> str:
+    """Constructs a detailed system prompt for the AI to act as an expert voice director."""
+    if not persona:
+        return None
     
-    return "\n".join(prompt_parts)
+    p = dict(persona)
+    return _build_system_prompt(
+        p.get('role_name', 'an AI assistant'),
+        p.get('goal', 'To assist the user.'),
+        p.get('personality', 'Standard AI personality.'),
+    )
+
+@lru_cache(maxsize=1024)
+def _build_system_prompt(role_name: str, goal: str, personality: str) -> str:
+    """Builds the prompt text, cached by the persona fields it uses."""
+    return _PERSONA_PROMPT_TEMPLATE.format_map({
+        'role_name': role_name,
+        'goal': goal,
+        'personality': personality,
+        'ssml_instructions': _SSML_INSTRUCTIONS,
+    })
 
 
 @router.post("/start", response_model=StartChatSessionResponse, status_code=status.HTTP_201_CREATED)
@@ -83,20 +219,20 @@ async def start_chat_session(request: StartChatSessionRequest, db_pool=Depends(g
     async with db_pool.acquire() as connection:
         try:
             result = await connection.fetchrow(
-                "INSERT INTO chat_sessions (user_id, persona_id, bot_version) VALUES ($1, $2, $3) RETURNING *",
+                _INSERT_SESSION_SQL,
                 request.user_id, request.persona_id, request.bot_version
             )
             if result:
                 return StartChatSessionResponse(
-                    session_id=str(result['session_id']), 
+                    session_id=result['session_id'], 
                     persona_id=result['persona_id'],
                     bot_version=result['bot_version'],
                     history=[]
                 )
             else:
                 raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to create chat session.")
-        except Exception as e:
-            print(f"Error creating chat session: {e}")
+        except Exception:
+            logger.exception("Error creating chat session")
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error.")
 
 @router.get("/{session_id}", response_model=ChatSessionResponse, status_code=status.HTTP_200_OK)
@@ -104,148 +240,210 @@ async def get_chat_history(session_id: uuid.UUID, db_pool=Depends(get_db_pool)):
     if not db_pool:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database connection is not available.")
     async with db_pool.acquire() as connection:
-        session_record = await connection.fetchrow("SELECT * FROM chat_sessions WHERE session_id = $1", session_id)
+        session_record = await connection.fetchrow(_SELECT_HISTORY_SQL, session_id)
         if not session_record:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Chat session with ID '{session_id}' not found.")
-        session_voice_id = DEFAULT_POLLY_VOICE_ID
-        persona_id = session_record.get('persona_id')
-        if persona_id:
-            persona_record = await connection.fetchrow("SELECT voice_id FROM personas WHERE prompt_id = $1", persona_id)
-            if persona_record and persona_record.get('voice_id'):
-                session_voice_id = persona_record.get('voice_id')
-        history_data = session_record['history']
-        if isinstance(history_data, str):
-            history_data = json.loads(history_data)
-        
-        enriched_history = []
-        for msg_data in history_data:
-            msg = ChatMessage.parse_obj(msg_data)
-            if msg.role == "model":
-                text_for_audio = msg.ssml or msg.content
-                filename = generate_audio_filename(text_for_audio, session_voice_id)
-                msg.audio_url = get_presigned_url(filename)
-            enriched_history.append(msg)
-        return ChatSessionResponse(
-            session_id=str(session_record['session_id']), 
-            session_name=session_record['session_name'], 
-            persona_id=session_record['persona_id'], 
-            bot_version=session_record.get('bot_version') or GEMINI_MODEL_VERSION,
-            history=enriched_history
-        )
+        session_voice_id = session_record.get('voice_id') or DEFAULT_POLLY_VOICE_ID
+        history_data = session_record['history'] or []
+
+    # Stored history was validated when this service wrote it, so it is shaped into the
+    # ChatMessage fields directly and returned as-is, skipping Pydantic validation and
+    # FastAPI's response_model round trip (the model still documents the schema).
+    history = [
+        {"role": msg["role"], "content": msg["content"], "ssml": msg.get("ssml"), "audio_url": None}
+        for msg in history_data
+    ]
+    model_messages = [msg for msg in history if msg["role"] == "model"]
+    filenames = [generate_audio_filename(msg["ssml"] or msg["content"], session_voice_id) for msg in model_messages]
+    # Sign the whole batch in a worker thread instead of one by one on the event loop.
+    audio_urls = await asyncio.to_thread(get_presigned_urls, filenames)
+    for msg, audio_url in zip(model_messages, audio_urls):
+        msg["audio_url"] = audio_url
+    return ORJSONResponse({
+        "session_id": session_id,
+        "session_name": session_record['session_name'],
+        "persona_id": session_record['persona_id'],
+        "bot_version": session_record.get('bot_version') or GEMINI_MODEL_VERSION,
+        "history": history,
+    })
 
 @router.post("/{session_id}/message", response_model=ChatSessionResponse, status_code=status.HTTP_200_OK)
-async def handle_chat_message(session_id: uuid.UUID, request: MessageRequest, response: Response, db_pool=Depends(get_db_pool)):
+async def handle_chat_message(session_id: uuid.UUID, request: MessageRequest, db_pool=Depends(get_db_pool)):
     if not db_pool:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database connection is not available.")
+    cached_history = _history_cache.get(session_id)
+    cached_xmin = cached_history[0] if cached_history else None
+    # The connection is only held for the read here and for the write after the Gemini
+    # call, not across the multi-second model round trip.
     async with db_pool.acquire() as connection:
-        async with connection.transaction():
-            if request.persona_id is not None:
-                await connection.execute("UPDATE chat_sessions SET persona_id = $1 WHERE session_id = $2", request.persona_id, session_id)
-            if request.bot_version is not None:
-                await connection.execute("UPDATE chat_sessions SET bot_version = $1 WHERE session_id = $2", request.bot_version, session_id)
-
-            session_record = await connection.fetchrow("SELECT * FROM chat_sessions WHERE session_id = $1", session_id)
-            if not session_record:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Chat session with ID '{session_id}' not found.")
-            
-            session_voice_id = DEFAULT_POLLY_VOICE_ID
-            default_system_prompt = None
-            persona_id = session_record.get('persona_id')
-            if persona_id:
-                persona_record = await connection.fetchrow("SELECT * FROM personas WHERE prompt_id = $1", persona_id)
-                if persona_record:
-                    default_system_prompt = construct_system_prompt_from_persona(persona_record)
-                    if persona_record.get('voice_id'):
-                        session_voice_id = persona_record.get('voice_id')
-
-            history_data = session_record['history']
-            if isinstance(history_data, str):
-                history_data = json.loads(history_data)
-            
-            is_first_message = not history_data
-            history = [ChatMessage.parse_obj(msg) for msg in history_data]
-            history.append(ChatMessage(role="user", content=request.message))
-            
-            system_instruction_override = None
-            generation_config_override = None
-            if request.config:
-                config_dict = request.config.dict(exclude_unset=True)
-                if "system_instruction" in config_dict:
-                    system_instruction_override = config_dict.pop("system_instruction")
-                generation_config_override = GenerationConfig(**config_dict)
-
-            final_system_instruction = system_instruction_override if system_instruction_override is not None else default_system_prompt
-            final_bot_version = session_record.get('bot_version') or GEMINI_MODEL_VERSION
-            
-            try:
-                model = genai.GenerativeModel(final_bot_version, system_instruction=final_system_instruction)
-                
-                while True:
-                    gemini_history_for_count = [{"role": msg.role, "parts": [msg.content]} for msg in history]
-                    total_tokens = await model.count_tokens_async(gemini_history_for_count)
-                    if total_tokens.total_tokens <= MAX_CONVERSATION_TOKENS: break
-                    if len(history) > 2: history = history[2:]
-                    else: break
-                
-                gemini_history = [{"role": msg.role, "parts": [msg.content]} for msg in history]
-
-                chat = model.start_chat(history=[m for m in gemini_history[:-1]])
-                response_obj = await chat.send_message_async(
-                    content=gemini_history[-1]['parts'],
-                    generation_config=generation_config_override
-                )
-                ai_response_raw = response_obj.text
-
-                display_text = ai_response_raw
-                ssml_text = None
-                text_for_audio = display_text
-                text_type_for_audio = 'text'
-
-                if "[SSML_TEXT]" in ai_response_raw:
-                    parts = ai_response_raw.split("[SSML_TEXT]", 1)
-                    display_text_part = parts[0].replace("[DISPLAY_TEXT]", "").strip()
-                    ssml_text_part = parts[1].strip()
-
-                    if display_text_part and ssml_text_part:
-                        display_text = display_text_part
-                        ssml_text = ssml_text_part
-                        text_for_audio = ssml_text
-                        text_type_for_audio = 'ssml'
-                        print("--- AI Response Analysis ---")
-                        print(f"Raw AI Response: {ai_response_raw}")
-                        print("SSML PARSED SUCCESSFULLY using delimiter.")
-                        print("--------------------------")
-                    else:
-                        print(f"WARNING: AI used delimiter but parts were empty. Falling back. Raw: {ai_response_raw}")
-                else:
-                    print(f"WARNING: AI did not use delimiter. Falling back. Raw: {ai_response_raw}")
-
-                audio_url = await get_or_create_audio_url(text_for_audio, session_voice_id, text_type_for_audio)
-                
-                history.append(ChatMessage(role="model", content=display_text, ssml=ssml_text, audio_url=audio_url))
-
-            except google_exceptions.NotFound as e:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid bot_version: The model '{final_bot_version}' was not found.")
-            except Exception as e:
-                print(f"Error communicating with Gemini API: {e}")
-                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Failed to get response from AI model.")
-            
-            updated_history_json = [msg.dict() for msg in history]
-            
+        session_record = await connection.fetchrow(
+            _SELECT_MESSAGE_SESSION_SQL, session_id, cached_xmin, request.persona_id, request.bot_version
+        )
+    if not session_record:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Chat session with ID '{session_id}' not found.")
+    
+    session_voice_id = DEFAULT_POLLY_VOICE_ID
+    default_system_prompt = None
+    persona_id = session_record.get('persona_id')
+    if session_record['persona_prompt_id'] is not None:
+        default_system_prompt = construct_system_prompt_from_persona(session_record)
+        if session_record.get('voice_id'):
+            session_voice_id = session_record.get('voice_id')
+
+    is_first_message = session_record['history_length'] == 0
+    if is_first_message:
+        history_data = []
+    elif session_record['history_cached']:
+        history_data = cached_history[1]
+    else:
+        history_data = session_record['history']
+    
+    # Stored history was validated when it was written; keep it as plain dicts and
+    # only build the new messages; the request message was validated by MessageRequest.
+    history = list(history_data)
+    history.append({"role": "user", "content": request.message, "ssml": None, "audio_url": None})
+    
+    system_instruction_override = None
+    generation_config_override = None
+    if request.config:
+        config_dict = request.config.model_dump(exclude_unset=True)
+        if "system_instruction" in config_dict:
+            system_instruction_override = config_dict.pop("system_instruction")
+        generation_config_override = GenerationConfig(**config_dict)
+
+    final_system_instruction = system_instruction_override if system_instruction_override is not None else default_system_prompt
+    final_bot_version = session_record.get('bot_version') or GEMINI_MODEL_VERSION
+    if _is_unknown_bot_version(final_bot_version):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid bot_version: The model '{final_bot_version}' was not found.")
+    
+    try:
+        model = get_generative_model(final_bot_version, final_system_instruction)
+        
+        gemini_history = [{"role": msg["role"], "parts": [msg["content"]]} for msg in history]
+
+        # Per-message token estimates are stored next to the history, so only new
+        # messages are measured, locally, with no tokenizer round trip before the
+        # Gemini call. Sessions saved before history_tokens existed are estimated
+        # in full once and backfilled on write.
+        history_tokens = list(session_record['history_tokens'] or [])
+        if len(history_tokens) != len(history_data):
+            history_tokens = []
+        history_tokens.extend(estimate_tokens(msg["content"]) for msg in history[len(history_tokens):])
+
+        total_tokens = sum(history_tokens)
+        dropped = 0
+        while total_tokens > MAX_CONVERSATION_TOKENS and len(history) - dropped > 2:
+            total_tokens -= history_tokens[dropped] + history_tokens[dropped + 1]
+            dropped += 2
+        if dropped:
+            # Trim all three lists in lockstep rather than rebuilding the Gemini payload.
+            history = history[dropped:]
+            gemini_history = gemini_history[dropped:]
+            history_tokens = history_tokens[dropped:]
+
+        chat = model.start_chat(history=gemini_history[:-1])
+        response_obj = await chat.send_message_async(
+            content=gemini_history[-1]['parts'],
+            generation_config=generation_config_override
+        )
+        ai_response_raw = response_obj.text
+
+        display_text = ai_response_raw
+        ssml_text = None
+        text_for_audio = display_text
+        text_type_for_audio = 'text'
+
+        if "[SSML_TEXT]" in ai_response_raw:
+            parts = ai_response_raw.split("[SSML_TEXT]", 1)
+            display_text_part = parts[0].replace("[DISPLAY_TEXT]", "").strip()
+            ssml_text_part = parts[1].strip()
+
+            if display_text_part and ssml_text_part:
+                display_text = display_text_part
+                ssml_text = ssml_text_part
+                text_for_audio = ssml_text
+                text_type_for_audio = 'ssml'
+                logger.debug("SSML parsed successfully using delimiter. Raw AI response: %s", ai_response_raw)
+            else:
+                logger.warning("AI used delimiter but parts were empty. Falling back. Raw: %s", ai_response_raw)
+        else:
+            logger.warning("AI did not use delimiter. Falling back. Raw: %s", ai_response_raw)
+
+        model_message = {"role": "model", "content": display_text, "ssml": ssml_text, "audio_url": None}
+        history.append(model_message)
+
+    except google_exceptions.NotFound as e:
+        _remember_unknown_bot_version(final_bot_version)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid bot_version: The model '{final_bot_version}' was not found.")
+    except Exception:
+        logger.exception("Error communicating with Gemini API")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Failed to get response from AI model.")
+    
+    # The stored history doesn't need the pre-signed audio URL (get_chat_history
+    # re-signs on read), so audio synthesis runs while the reply is counted and
+    # the history is written.
+    audio_task = asyncio.create_task(
+        get_or_create_audio_url(text_for_audio, session_voice_id, text_type_for_audio)
+    )
+
+    history_tokens.append(estimate_tokens(display_text))
+
+    # Only the user message and the reply cross the wire; trimming happens in SQL.
+    new_messages_json = history[-2:]
+    
+    row_xmin = session_record['row_xmin']
+    new_session_name = request.message[:99] if is_first_message else None
+    try:
+        async with db_pool.acquire() as connection:
             if is_first_message:
-                new_session_name = request.message[:99]
-                await connection.execute("UPDATE chat_sessions SET history = $1, session_name = $2 WHERE session_id = $3", updated_history_json, new_session_name, session_id)
+                new_xmin = await connection.fetchval(
+                    _UPDATE_HISTORY_AND_NAME_SQL, new_messages_json, dropped, history_tokens, new_session_name,
+                    session_id, row_xmin, request.persona_id, request.bot_version
+                )
             else:
-                await connection.execute("UPDATE chat_sessions SET history = $1 WHERE session_id = $2", updated_history_json, session_id)
-            
-            final_session_name = new_session_name if is_first_message else session_record['session_name']
-            
-            response.headers["X-Bot-Version"] = final_bot_version
-
-            return ChatSessionResponse(
-                session_id=str(session_id), 
-                session_name=final_session_name, 
-                persona_id=persona_id,
-                bot_version=final_bot_version,
-                history=history
-            )
+                new_xmin = await connection.fetchval(
+                    _UPDATE_HISTORY_SQL, new_messages_json, dropped, history_tokens,
+                    session_id, row_xmin, request.persona_id, request.bot_version
+                )
+            if new_xmin is None:
+                # Another turn on this session was written while this one waited on Gemini.
+                logger.warning("Session %s changed during the model call; appending without trimming.", session_id)
+                conflict_xmin = await connection.fetchval(
+                    _APPEND_HISTORY_CONFLICT_SQL, new_messages_json, session_id, request.persona_id, request.bot_version
+                )
+                if conflict_xmin is None:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Chat session with ID '{session_id}' not found.")
+                # The full stored history is no longer known here, so don't cache it.
+                _history_cache.pop(session_id, None)
+            else:
+                # Copy the reply before its audio_url is filled in, matching what was stored.
+                _cache_history(session_id, new_xmin, history[:-1] + [dict(model_message)])
+    except BaseException:
+        # The turn wasn't saved; don't leave the audio synthesis running unobserved.
+        audio_task.cancel()
+        raise
+
+    # The turn is already saved, so an audio failure must not turn into a 500 (a client
+    # retry would then duplicate the turn); the reply is returned without audio.
+    try:
+        model_message["audio_url"] = await audio_task
+    except Exception:
+        logger.exception("Audio generation failed for session %s", session_id)
+    
+    final_session_name = new_session_name if is_first_message else session_record['session_name']
+    
+    # history is already plain dicts in ChatMessage shape; serialize it directly rather
+    # than validating every message into ChatSessionResponse and dumping it back.
+    return ORJSONResponse(
+        {
+            "session_id": session_id,
+            "session_name": final_session_name,
+            "persona_id": persona_id,
+            "bot_version": final_bot_version,
+            "history": [
+                {"role": msg["role"], "content": msg["content"], "ssml": msg.get("ssml"), "audio_url": msg.get("audio_url")}
+                for msg in history
+            ],
+        },
+        headers={"X-Bot-Version": final_bot_version},
+    )
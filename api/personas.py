@@ -1,11 +1,34 @@
+import logging
 from typing import List
 import asyncpg
-from fastapi import APIRouter, HTTPException, status, Response, Depends
+from fastapi import APIRouter, HTTPException, status, Response, Depends, Query
 
 from db.session import get_db_pool
 from models.persona import Persona
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Columns a client may write; the INSERT is built once from the model instead of per request.
+PERSONA_WRITE_COLUMNS = tuple(name for name in Persona.model_fields if name not in ('prompt_id', 'created_at'))
+_INSERT_PERSONA_SQL = (
+    f"INSERT INTO personas ({', '.join(PERSONA_WRITE_COLUMNS)}) "
+    f"VALUES ({', '.join(f'${i + 1}' for i in range(len(PERSONA_WRITE_COLUMNS)))}) RETURNING *"
+)
+# One static UPDATE: $2 is the list of fields the client actually sent, so unset fields keep
+# their stored value while an explicit null still clears the column.
+_UPDATE_PERSONA_SQL = (
+    "UPDATE personas SET "
+    + ", ".join(
+        f"{column} = CASE WHEN '{column}' = ANY($2::text[]) THEN ${i} ELSE {column} END"
+        for i, column in enumerate(PERSONA_WRITE_COLUMNS, start=3)
+    )
+    + " WHERE prompt_id = $1 RETURNING *"
+)
+
+def _bind_persona(persona: Persona) -> tuple:
+    """Returns the persona's values in PERSONA_WRITE_COLUMNS order."""
+    return tuple(getattr(persona, column) for column in PERSONA_WRITE_COLUMNS)
 
 @router.post("/", response_model=Persona, status_code=status.HTTP_201_CREATED)
 async def create_persona(persona: Persona, db_pool=Depends(get_db_pool)):
@@ -13,19 +36,33 @@ async def create_persona(persona: Persona, db_pool=Depends(get_db_pool)):
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database connection is not available.")
     async with db_pool.acquire() as connection:
         try:
-            data = persona.dict(exclude={'prompt_id', 'created_at'})
-            columns = ", ".join(data.keys())
-            placeholders = ", ".join([f"${i+1}" for i in range(len(data))])
-            
-            query = f"INSERT INTO personas ({columns}) VALUES ({placeholders}) RETURNING *"
-            
-            record = await connection.fetchrow(query, *data.values())
+            record = await connection.fetchrow(_INSERT_PERSONA_SQL, *_bind_persona(persona))
             return dict(record)
         except asyncpg.exceptions.UniqueViolationError:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Persona with role_name '{persona.role_name}' already exists.")
-        except Exception as e:
-            print(f"Error creating persona: {e}")
+        except Exception:
+            logger.exception("Error creating persona")
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error.")
+
+@router.post("/bulk", status_code=status.HTTP_201_CREATED)
+async def create_personas_bulk(personas: List[Persona], db_pool=Depends(get_db_pool)):
+    """Imports many personas in one binary COPY instead of one INSERT per row."""
+    if not db_pool:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database connection is not available.")
+    if not personas:
+        return {"inserted": 0}
+    async with db_pool.acquire() as connection:
+        try:
+            await connection.copy_records_to_table(
+                'personas', records=[_bind_persona(persona) for persona in personas], columns=PERSONA_WRITE_COLUMNS
+            )
+        except asyncpg.exceptions.UniqueViolationError as e:
+            # COPY is all-or-nothing: nothing was imported.
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Bulk import rejected, duplicate persona: {e.detail or e}")
+        except Exception:
+            logger.exception("Error importing personas")
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error.")
+    return {"inserted": len(personas)}
 
 @router.get("/", response_model=List[Persona])
 async def get_all_personas(db_pool=Depends(get_db_pool)):
@@ -50,12 +87,8 @@ async def update_persona(prompt_id: int, persona: Persona, db_pool=Depends(get_d
     if not db_pool:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database connection is not available.")
     async with db_pool.acquire() as connection:
-        data = persona.dict(exclude={'prompt_id', 'created_at'}, exclude_unset=True)
-        set_clauses = ", ".join([f"{key} = ${i+2}" for i, key in enumerate(data.keys())])
-        
-        query = f"UPDATE personas SET {set_clauses} WHERE prompt_id = $1 RETURNING *"
-        
-        record = await connection.fetchrow(query, prompt_id, *data.values())
+        fields_set = [column for column in PERSONA_WRITE_COLUMNS if column in persona.model_fields_set]
+        record = await connection.fetchrow(_UPDATE_PERSONA_SQL, prompt_id, fields_set, *_bind_persona(persona))
         if not record:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Persona with prompt_id {prompt_id} not found.")
         return dict(record)
@@ -69,3 +102,12 @@ async def delete_persona(prompt_id: int, db_pool=Depends(get_db_pool)):
         if result == "DELETE 0":
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Persona with prompt_id {prompt_id} not found.")
         return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@router.delete("/")
+async def delete_personas_bulk(prompt_id: List[int] = Query(..., min_length=1), db_pool=Depends(get_db_pool)):
+    """Deletes every persona whose prompt_id is listed (?prompt_id=1&prompt_id=2) in one statement."""
+    if not db_pool:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database connection is not available.")
+    async with db_pool.acquire() as connection:
+        result = await connection.execute("DELETE FROM personas WHERE prompt_id = ANY($1::int[])", prompt_id)
+    return {"deleted": int(result.split()[-1])}
@@ -1,5 +1,4 @@
-import io
-import pandas as pd
+import asyncio
 import jinja2
 from fastapi import APIRouter, File, UploadFile, Form, HTTPException
 from fastapi.responses import HTMLResponse
@@ -9,11 +8,12 @@ router = APIRouter()
 # --- CẤU HÌNH & DATA MAPPING (CONSTANTS) ---
 NUM_MEMBERS = 18
 BOSS_NAME = "Công"
-RESIGNED_MEMBERS = [
+# Tên cột Excel được strip() trước khi tra cứu nên key cũng phải strip sẵn
+RESIGNED_MEMBERS = frozenset(name.strip() for name in [
     'Vũ Thiên Ân', 'Phùng Minh Cường', 'Lê Quốc Thái', 'Nguyễn Thị Tiên',
     'Phạm Tiến Dũng', 'Hà Minh Tân', 'Đại Anh Dũng ', 'Phạm Như Hòa',
     'Nguyễn Hoàng Gia Khanh', 'Nguyễn Tống Gia Huy'
-]
+])
 
 USER_INFO = {
     'Nguyễn Trần Phúc': {'project': 'Migration', 'sub_system': 'Limit/PLN', 'hdb_lead': 'Hoàng Thị Thu Thảo'},
@@ -25,6 +25,7 @@ USER_INFO = {
     'Nguyễn Tấn Dũng': {'project': 'FE Portal', 'sub_system': 'Onboarding', 'hdb_lead': 'Tech Lead: Nguyễn Tiến Phúc, Tô Thành Duy'},
     'Đinh Thành Nguyên Đạt': {'project': 'Phần Mềm Gsoft', 'sub_system': '', 'hdb_lead': 'Hoàng Thị Thu Thảo'},
 }
+USER_INFO_DEFAULT = {'project': 'Khác', 'sub_system': '-', 'hdb_lead': '-'}
 
 # --- HTML TEMPLATE ---
 HTML_TEMPLATE = """
@@ -76,83 +77,109 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# Biên dịch template 1 lần khi import, mỗi request chỉ còn render
+REPORT_TEMPLATE = jinja2.Environment(loader=jinja2.BaseLoader()).from_string(HTML_TEMPLATE)
+
 # --- HELPER FUNCTIONS ---
-def calculate_spans(data_list, column_name):
-    """Tính toán rowspan cho cột."""
-    spans = []
-    i = 0
-    while i < len(data_list):
-        val = data_list[i][column_name]
-        count = 1
-        for j in range(i + 1, len(data_list)):
-            if data_list[j][column_name] == val and val not in ["", "-"]:
-                count += 1
+def calculate_spans(data_list, column_names):
+    """Tính toán rowspan cho nhiều cột trong 1 lần duyệt."""
+    spans = {col: [0] * len(data_list) for col in column_names}
+    run_start = dict.fromkeys(column_names, 0)
+    for idx, row in enumerate(data_list):
+        for col in column_names:
+            val = row[col]
+            start = run_start[col]
+            # Ô trống hoặc "-" không gộp; giá trị khác giá trị đầu run thì mở run mới
+            if idx == 0 or val in ("", "-") or val != data_list[start][col]:
+                run_start[col] = idx
+                spans[col][idx] = 1
             else:
-                break
-        for k in range(count):
-            spans.append(count if k == 0 else 0)
-        i += count
+                spans[col][start] += 1
     return spans
 
-def process_excel_data(file_content: bytes, date_input: str):
-    """Xử lý logic chính: Đọc Excel -> Filter -> Map Data -> Render HTML"""
+def format_date_column(date_col):
+    """Chuyển cột ngày về string format MM/DD/YYYY."""
+    import pandas as pd
+    if pd.api.types.is_datetime64_any_dtype(date_col):
+        return date_col.dt.strftime('%m/%d/%Y').fillna('')
+    return date_col.astype(str)
+
+def match_report_date(date_col, date_input):
+    """Mask các hàng có ngày khớp date_input, tránh stringify cả cột khi không cần."""
+    import numpy as np
+    import pandas as pd
+    if pd.api.types.is_datetime64_any_dtype(date_col):
+        # Parse date_input 1 lần rồi so sánh trên datetime thay vì strftime từng ô
+        day = pd.to_datetime(date_input, format='%m/%d/%Y', errors='coerce')
+        # Chỉ nhận đúng chuỗi mà strftime('%m/%d/%Y') sinh ra (vd. "12/2/2025" không khớp)
+        if pd.isna(day) or day.strftime('%m/%d/%Y') != date_input:
+            return np.zeros(len(date_col), dtype=bool)
+        return date_col.dt.normalize().eq(day).to_numpy()
+
+    # Cột dạng text: so sánh trực tiếp trước, chỉ astype(str) khi không có ô nào khớp
+    matches = date_col.eq(date_input).to_numpy()
+    if not matches.any():
+        matches = date_col.astype(str).eq(date_input).to_numpy()
+    return matches
+
+def process_excel_data(excel_file, date_input: str):
+    """Xử lý logic chính: Đọc Excel -> Filter -> Map Data -> Render HTML
+
+    excel_file là file-like object (vd. UploadFile.file), đọc trực tiếp không copy ra bytes.
+    """
+    # pandas/numpy chiếm phần lớn thời gian import của app nhưng chỉ endpoint này dùng,
+    # nên import lúc cần (lần đầu gọi) thay vì lúc khởi động
+    import pandas as pd
+
     try:
-        # Đọc file từ memory (bytes) thay vì file path
-        df = pd.read_excel(io.BytesIO(file_content))
+        # Đọc thẳng từ file-like object thay vì file path, dùng engine calamine (Rust) thay cho openpyxl
+        df = pd.read_excel(excel_file, engine='calamine')
     except Exception as e:
         raise ValueError(f"Không thể đọc file Excel. Lỗi: {str(e)}")
 
-    # Fix lỗi ngày tháng: Chuyển cột đầu tiên về string format MM/DD/YYYY
-    if hasattr(df.iloc[:, 0], 'dt'):
-        df.iloc[:, 0] = df.iloc[:, 0].dt.strftime('%m/%d/%Y').fillna('')
-    else:
-        df.iloc[:, 0] = df.iloc[:, 0].astype(str)
-
-    # Filter theo ngày
-    filtered = df[df.iloc[:, 0] == date_input]
-
-    if filtered.empty:
-        # Lấy danh sách ngày có trong file để gợi ý lỗi
-        available_dates = df.iloc[:, 0].unique().tolist()
+    # Filter theo ngày: chỉ cần vị trí hàng đầu tiên khớp, không dựng DataFrame con
+    date_col = df.iloc[:, 0]
+    matches = match_report_date(date_col, date_input)
+    if not matches.any():
+        # Lấy danh sách ngày có trong file để gợi ý lỗi (chỉ format chuỗi ở nhánh lỗi)
+        available_dates = format_date_column(date_col).unique().tolist()
         raise LookupError(f"Không tìm thấy dữ liệu cho ngày {date_input}. Các ngày có trong file: {available_dates[:5]}...")
 
-    # Lấy hàng dữ liệu đầu tiên tìm được
-    member_data_row = filtered.iloc[0]
-    rows = []
-
-    # Duyệt qua các cột nhân sự
+    # Lấy các cột nhân sự của hàng đầu tiên tìm được
     # Kiểm tra bounds để tránh lỗi index nếu file excel thay đổi cấu trúc
     max_col = min(1 + NUM_MEMBERS, len(df.columns))
-    
-    for i in range(1, max_col):
-        member_name = df.columns[i].strip()
-        report_text = member_data_row.iloc[i] # Dùng .iloc để an toàn hơn
-
-        if member_name in RESIGNED_MEMBERS:
-            continue
+    member_data_row = df.iloc[int(matches.argmax()), 1:max_col]
+    member_data_row.index = [name.strip() for name in member_data_row.index]
 
-        if pd.notnull(report_text) and str(report_text).strip() != "":
-            info = USER_INFO.get(member_name, {'project': 'Khác', 'sub_system': '-', 'hdb_lead': '-'})
+    # Bỏ nhân sự đã nghỉ và ô trống (vector hoá trên cả hàng)
+    member_data_row = member_data_row[~member_data_row.index.isin(RESIGNED_MEMBERS) & member_data_row.notna()]
+    reports = member_data_row.astype(str)
+    reports = reports[reports.str.strip().ne('')]
 
-            # Tách dòng công việc
-            tasks = [t.strip('- ').strip() for t in str(report_text).split('\n') if t.strip()]
-            formatted_tasks = "".join([f"<div>- {t}</div>" for t in tasks])
-
-            rows.append({
-                'project': info['project'],
-                'sub_system': info['sub_system'],
-                'hdb_lead': info['hdb_lead'],
-                'kms_staff': member_name,
-                'manday': 1,
-                'tasks': formatted_tasks
-            })
+    rows = []
+    for member_name, report_text in reports.items():
+        info = USER_INFO.get(member_name, USER_INFO_DEFAULT)
+
+        # Tách dòng công việc
+        tasks = [t.strip('- ').strip() for t in report_text.split('\n') if t.strip()]
+        formatted_tasks = "".join([f"<div>- {t}</div>" for t in tasks])
+
+        rows.append({
+            'project': info['project'],
+            'sub_system': info['sub_system'],
+            'hdb_lead': info['hdb_lead'],
+            'kms_staff': member_name,
+            'manday': 1,
+            'tasks': formatted_tasks
+        })
 
     if not rows:
         raise LookupError("Tìm thấy ngày nhưng không có nhân sự nào báo cáo công việc (trống dữ liệu).")
 
     # Logic gộp ô (Rowspan)
-    project_spans = calculate_spans(rows, 'project')
-    hdb_spans = calculate_spans(rows, 'hdb_lead')
+    spans = calculate_spans(rows, ('project', 'hdb_lead'))
+    project_spans = spans['project']
+    hdb_spans = spans['hdb_lead']
 
     for idx, row in enumerate(rows):
         row['no'] = idx + 1
@@ -160,8 +187,7 @@ def process_excel_data(file_content: bytes, date_input: str):
         row['h_span'] = hdb_spans[idx]
 
     # Render Template
-    template = jinja2.Environment(loader=jinja2.BaseLoader()).from_string(HTML_TEMPLATE)
-    html_content = template.render(boss_name=BOSS_NAME, report_date=date_input, rows=rows)
+    html_content = REPORT_TEMPLATE.render(boss_name=BOSS_NAME, report_date=date_input, rows=rows)
     
     return html_content
 
@@ -178,12 +204,10 @@ async def generate_report_endpoint(
     if not file.filename.endswith(".xlsx"):
         raise HTTPException(status_code=400, detail="Chỉ chấp nhận file .xlsx")
 
-    # 2. Read file content
-    content = await file.read()
-
-    # 3. Process logic
+    # 2. UploadFile.file đã là SpooledTemporaryFile -> đưa thẳng cho pandas, không đọc toàn bộ ra bytes
+    # 3. Process logic (pandas/calamine chạy đồng bộ -> đẩy sang thread để không chặn event loop)
     try:
-        html_result = process_excel_data(content, report_date)
+        html_result = await asyncio.to_thread(process_excel_data, file.file, report_date)
         return HTMLResponse(content=html_result, status_code=200)
     
     except LookupError as e:
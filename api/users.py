@@ -1,3 +1,4 @@
+import logging
 from typing import List
 import uuid
 from fastapi import APIRouter, HTTPException, status, Depends
@@ -6,6 +7,7 @@ from db.session import get_db_pool
 from models.chat import UserSessionInfo
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 @router.get("/{user_id}/sessions", response_model=List[UserSessionInfo], status_code=status.HTTP_200_OK)
 async def get_user_sessions(user_id: int, db_pool=Depends(get_db_pool)):
@@ -24,7 +26,8 @@ async def get_user_sessions(user_id: int, db_pool=Depends(get_db_pool)):
             ORDER BY updated_at DESC;
             """
             records = await connection.fetch(query, user_id)
-            return [UserSessionInfo(session_id=r['session_id'], updated_at=r['updated_at'], title=r['title']) for r in records]
-        except Exception as e:
-            print(f"Error retrieving user sessions: {e}")
+            # response_model validates and serializes the rows once; no per-row model here.
+            return [dict(record) for record in records]
+        except Exception:
+            logger.exception("Error retrieving user sessions")
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error.")
@@ -1,3 +1,6 @@
+import asyncio
+import logging
+import time
 from typing import List
 from fastapi import APIRouter, HTTPException, status, Depends
 
@@ -5,21 +8,31 @@ from services.aws import polly_client
 from models.voice import VoiceResponse
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Polly's voice catalogue changes rarely, so the formatted list is cached in-process.
+VOICES_CACHE_TTL_SECONDS = 24 * 60 * 60
+_voices_cache: tuple[float, List[VoiceResponse]] = (0.0, [])
 
 @router.get("/", response_model=List[VoiceResponse])
 async def get_available_voices():
     """
     Fetches a list of available English neural voices from Amazon Polly.
     """
+    global _voices_cache
     if not polly_client:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="AWS Polly client is not configured. Cannot fetch voices."
         )
 
+    cached_at, cached_voices = _voices_cache
+    if cached_voices and time.monotonic() - cached_at < VOICES_CACHE_TTL_SECONDS:
+        return cached_voices
+
     try:
-        # Call Polly to get all neural voices
-        response = polly_client.describe_voices(Engine='neural')
+        # Call Polly to get all neural voices (blocking boto3 call, run off the event loop)
+        response = await asyncio.to_thread(polly_client.describe_voices, Engine='neural')
         
         voices = response.get('Voices', [])
         
@@ -41,10 +54,11 @@ async def get_available_voices():
         # Sort by language name and then by voice name for a clean list
         english_voices.sort(key=lambda v: (v.language_name, v.name))
         
+        _voices_cache = (time.monotonic(), english_voices)
         return english_voices
 
-    except Exception as e:
-        print(f"ERROR: Failed to fetch voices from Polly: {e}")
+    except Exception:
+        logger.exception("Failed to fetch voices from Polly")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to retrieve voice list from the provider."
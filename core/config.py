@@ -1,81 +1,108 @@
+import logging
 import os
 import sys
 from urllib.parse import quote_plus
-from dotenv import load_dotenv
+
+from core.logging_config import setup_logging
 
 # --- Application Version ---
 APP_VERSION = "0.3.2-beta"
 
-# Load .env cho môi trường local (nếu có)
-load_dotenv()
+# Load .env cho môi trường local (nếu có). Trên ECS/Lambda không có file .env,
+# bỏ qua để khỏi import dotenv và dò thư mục tìm file
+if not os.environ.get("ECS_CONTAINER_METADATA_URI_V4") and not os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+    from dotenv import load_dotenv
+    load_dotenv()
 
-# --- 1. SAFE DEBUGGING: CHECK VARIABLES ---
-# In log để verify trên CloudWatch xem ECS đã inject secret thành công chưa
-print("\n--- [START] CHECKING ENVIRONMENT VARIABLES ---", flush=True)
+# Snapshot environment 1 lần sau load_dotenv, mọi lookup bên dưới đọc từ dict này
+_ENV = os.environ.copy()
 
-required_vars = ["DB_HOST", "DB_USER", "DB_PASSWORD", "DB_PORT", "DB_NAME"]
-missing_vars = []
+# Cấu hình logging ngay từ đây để log lúc import config cũng đi qua logger
+LOG_LEVEL = _ENV.get("LOG_LEVEL", "INFO").upper()
+setup_logging(LOG_LEVEL)
+logger = logging.getLogger(__name__)
 
-for var_name in required_vars:
-    value = os.getenv(var_name)
-    if value:
-        # Chỉ in độ dài để debug, KHÔNG in giá trị thật
-        print(f"✅ {var_name:<15}: FOUND | Length: {len(str(value))} chars", flush=True)
-    else:
-        print(f"❌ {var_name:<15}: MISSING", flush=True)
-        missing_vars.append(var_name)
+# --- 1. SAFE DEBUGGING: CHECK VARIABLES ---
+required_vars = ["DB_HOST", "DB_USER", "DB_PASSWORD", "DB_PORT", "DB_NAME"]
+missing_vars = [var_name for var_name in required_vars if not _ENV.get(var_name)]
 
+if missing_vars:
+    logger.warning("Missing environment variables: %s", ", ".join(missing_vars))
 
-print("--- [END] CHECKING ENVIRONMENT VARIABLES ---\n", flush=True)
+# Log chi tiết để verify trên CloudWatch xem ECS đã inject secret thành công chưa (chỉ khi CONFIG_DEBUG=1)
+if _ENV.get("CONFIG_DEBUG") == "1":
+    # Chỉ log độ dài để debug, KHÔNG log giá trị thật
+    logger.info(
+        "Environment variables check: %s",
+        ", ".join(f"{var_name}: FOUND ({len(_ENV[var_name])} chars)" if _ENV.get(var_name) else f"{var_name}: MISSING"
+                  for var_name in required_vars),
+    )
 
 # --- 2. DATABASE CONFIGURATION ---
-DATABASE_URL = f"postgresql://{os.getenv("DB_USER")}:{os.getenv("DB_PASSWORD")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_NAME")}"
-safe_url = f"postgresql://*******:******@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_NAME")}"
-print(f"INFO: Constructed DATABASE_URL: {safe_url}")
+DATABASE_URL = None
 
-# Nếu chưa có DATABASE_URL nhưng đủ các biến thành phần thì tự construct
-if not DATABASE_URL and not missing_vars:
+# Construct DATABASE_URL 1 lần từ các biến thành phần (khi đủ biến)
+if not missing_vars:
     try:
-        db_host = os.getenv("DB_HOST")
-        db_user = os.getenv("DB_USER")
-        db_pass = os.getenv("DB_PASSWORD")
-        db_port = os.getenv("DB_PORT")
-        db_name = os.getenv("DB_NAME")
+        db_host = _ENV["DB_HOST"]
+        db_port = _ENV["DB_PORT"]
+        db_name = _ENV["DB_NAME"]
 
         # Encode user/pass để xử lý ký tự đặc biệt (quan trọng)
-        encoded_user = quote_plus(db_user)
-        encoded_pass = quote_plus(db_pass)
+        encoded_user = quote_plus(_ENV["DB_USER"])
+        encoded_pass = quote_plus(_ENV["DB_PASSWORD"])
 
         # FIX: Sử dụng 'postgresql://' thay vì 'postgresql+asyncpg://'
         DATABASE_URL = f"postgresql://{encoded_user}:{encoded_pass}@{db_host}:{db_port}/{db_name}"
         
         # Log URL an toàn (che password)
         safe_url = f"postgresql://{encoded_user}:******@{db_host}:{db_port}/{db_name}"
-        print(f"INFO: Constructed DATABASE_URL: {safe_url}", flush=True)
+        logger.info("Constructed DATABASE_URL: %s", safe_url)
         
-    except Exception as e:
-        print(f"CRITICAL ERROR: Failed to construct DATABASE_URL. Error: {str(e)}", flush=True)
+    except Exception:
+        logger.exception("Failed to construct DATABASE_URL")
 
 # --- 3. VALIDATION ---
 if not DATABASE_URL:
-    print("CRITICAL ERROR: DATABASE_URL could not be set. Exiting...", flush=True)
+    logger.critical("DATABASE_URL could not be set. Exiting...")
     raise ValueError("DATABASE_URL could not be constructed. Check environment variables.")
 
 # --- 4. OTHER CONFIGURATIONS ---
+# Connection pool (asyncpg)
+DB_POOL_MIN_SIZE = int(_ENV.get("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(_ENV.get("DB_POOL_MAX_SIZE", "20"))
+# Chạy sau PgBouncer (transaction mode) thì phải tắt prepared statement cache
+DB_PGBOUNCER = _ENV.get("DB_PGBOUNCER") == "1"
+DB_STATEMENT_CACHE_SIZE = 0 if DB_PGBOUNCER else 1024
+# Tên hiển thị trong pg_stat_activity (PgBouncer cũng chấp nhận tham số này)
+DB_APPLICATION_NAME = _ENV.get("DB_APPLICATION_NAME", "eng4today")
+
 MAX_CONVERSATION_TOKENS = 20000
+# Số session giữ history trong bộ nhớ mỗi process (0 = tắt cache)
+SESSION_HISTORY_CACHE_SIZE = int(_ENV.get("SESSION_HISTORY_CACHE_SIZE", "256"))
+# Chỉ bật khi debug: middleware sẽ buffer toàn bộ request body để log
+LOG_REQUEST_BODY = _ENV.get("LOG_REQUEST_BODY") == "1"
+
+# CORS: danh sách origin cách nhau bởi dấu phẩy (mặc định "*" cho môi trường dev)
+CORS_ALLOW_ORIGINS = [origin.strip() for origin in _ENV.get("CORS_ALLOW_ORIGINS", "*").split(",") if origin.strip()]
 
 # Gemini
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_MODEL_VERSION = os.getenv("GEMINI_MODEL_VERSION", "gemini-1.5-pro")
+GEMINI_API_KEY = _ENV.get("GEMINI_API_KEY")
+# Giá trị chưa cấu hình (thiếu, rỗng hoặc placeholder trong .env mẫu)
+_GEMINI_API_KEY_PLACEHOLDERS = frozenset({None, "", "YOUR_GEMINI_API_KEY_HERE"})
+GEMINI_MODEL_VERSION = _ENV.get("GEMINI_MODEL_VERSION", "gemini-1.5-pro")
+
+# True khi đã có API key thật (không phải placeholder)
+GEMINI_CONFIGURED = GEMINI_API_KEY not in _GEMINI_API_KEY_PLACEHOLDERS
 
-if not GEMINI_API_KEY or GEMINI_API_KEY == "YOUR_GEMINI_API_KEY_HERE":
-    print("WARNING: GEMINI_API_KEY is missing or invalid.", flush=True)
+if not GEMINI_CONFIGURED:
+    logger.warning("GEMINI_API_KEY is missing or invalid.")
 
 # AWS Configuration
-AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-DEFAULT_POLLY_VOICE_ID = os.getenv("DEFAULT_POLLY_VOICE_ID", "Joanna")
+AWS_ACCESS_KEY_ID = _ENV.get("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = _ENV.get("AWS_SECRET_ACCESS_KEY")
+AWS_REGION = _ENV.get("AWS_REGION", "us-east-1")
+S3_BUCKET_NAME = _ENV.get("S3_BUCKET_NAME")
+DEFAULT_POLLY_VOICE_ID = _ENV.get("DEFAULT_POLLY_VOICE_ID", "Joanna")
 
-print(f"Successfully loaded configuration for version {APP_VERSION}.", flush=True)
+logger.info("Successfully loaded configuration for version %s.", APP_VERSION)
@@ -0,0 +1,52 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+_queue_handler = None
+_listener = None
+
+def setup_logging(level: str = "INFO") -> logging.handlers.QueueListener:
+    """
+    Routes all logging through a queue so records are written to stdout by a
+    background thread instead of blocking the event loop.
+    Returns the started listener. Calling it again while logging is set up
+    returns the running listener; call shutdown_logging() to flush and stop it.
+    """
+    global _queue_handler, _listener
+    if _listener is not None:
+        return _listener
+
+    log_queue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    root_logger.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # The listener thread is a daemon; flush on exit too, so records logged
+    # right before a failed import or crash still reach stdout.
+    atexit.register(shutdown_logging)
+    return _listener
+
+def shutdown_logging() -> None:
+    """
+    Stops the listener after it writes out pending records and detaches the
+    queue handler, so a later setup_logging() starts clean.
+    """
+    global _queue_handler, _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    atexit.unregister(shutdown_logging)
+    logging.getLogger().removeHandler(_queue_handler)
+    _queue_handler = None
+    _listener = None
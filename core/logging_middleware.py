@@ -1,68 +1,82 @@
+import logging
 import time
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import Message
+from fastapi import Request
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-class RequestLoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        # Store the request body to be used after the request is processed
-        request_body = await self.get_request_body(request)
+from core.config import LOG_REQUEST_BODY
 
-        start_time = time.time()
-        
-        # Process the request and get the response
-        response = await call_next(request)
-        
-        process_time = time.time() - start_time
-        
-        # Log details after the response has been generated
-        self.log_details(request, response, request_body, process_time)
-        
-        return response
+logger = logging.getLogger(__name__)
 
-    async def get_request_body(self, request: Request) -> bytes:
-        """
-        Reads the request body and leaves it available for subsequent reads.
-        """
-        body = await request.body()
-        # To make the body readable again for the actual endpoint, we need to
-        # create a new "receive" function.
-        async def receive() -> Message:
-            return {"type": "http.request", "body": body}
-        request._receive = receive
-        return body
+# Only these headers are useful when debugging; copying every header is wasted work.
+LOGGED_HEADERS = ('user-agent', 'content-type', 'content-length', 'x-forwarded-for', 'x-request-id')
 
-    def log_details(self, request: Request, response: Response, body: bytes, process_time: float):
-        """
-        Formats and prints the log message.
-        """
-        log_message = (
-            f"\n----- API Request Log -----\n"
-            f"Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-            f"Method: {request.method}\n"
-            f"URL: {request.url}\n"
-            f"Client IP: {request.client.host}\n"
-            f"Headers: {dict(request.headers)}\n"
-        )
+class RequestLoggingMiddleware:
+    """
+    Pure ASGI request logger. It wraps send (and receive, when bodies are logged)
+    instead of subclassing BaseHTTPMiddleware, so requests don't pay for an extra
+    task group and response re-streaming.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not logger.isEnabledFor(logging.INFO):
+            await self.app(scope, receive, send)
+            return
 
-        if body:
-            try:
-                log_message += f"Request Body: {body.decode('utf-8')}\n"
-            except UnicodeDecodeError:
-                log_message += f"Request Body: [Non-UTF-8 data, size: {len(body)} bytes]\n"
-        else:
-            log_message += "Request Body: [Empty]\n"
+        start_time = time.perf_counter()
+        response_start = {}
+        # The body is collected as the endpoint reads it, so the upload is never
+        # buffered ahead of the endpoint; only done when LOG_REQUEST_BODY is enabled.
+        body_chunks = [] if LOG_REQUEST_BODY else None
 
-        # Check for our custom bot version header in the response
-        bot_version = response.headers.get("x-bot-version")
-        if bot_version:
-            log_message += f"Bot Version Used: {bot_version}\n"
+        async def receive_and_capture() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                body_chunks.append(message.get("body", b""))
+            return message
 
-        log_message += (
-            f"---------------------------\n"
-            f"Response Status: {response.status_code}\n"
-            f"Process Time: {process_time:.4f}s\n"
-            f"----- End Log -----\n"
+        async def send_and_capture(message: Message):
+            if message["type"] == "http.response.start":
+                response_start["status"] = message["status"]
+                response_start["headers"] = message.get("headers", [])
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_capture if body_chunks is not None else receive, send_and_capture)
+        finally:
+            process_time = time.perf_counter() - start_time
+            # No response start means the app raised before responding (a 500).
+            status_code = response_start.get("status", 500)
+            bot_version = Headers(raw=response_start.get("headers", [])).get("x-bot-version", "-")
+            body = b"".join(body_chunks) if body_chunks is not None else None
+            self.log_details(Request(scope), status_code, bot_version, body, process_time)
+
+    def log_details(self, request: Request, status_code: int, bot_version: str, body: bytes | None, process_time: float):
+        """
+        Logs a one-line summary at INFO. Headers and the request body are only
+        materialized and decoded when DEBUG is enabled.
+        """
+        logger.info(
+            "%s %s %s -> %d in %.4fs (bot version: %s)",
+            request.method,
+            request.url.path,
+            request.client.host if request.client else "-",
+            status_code,
+            process_time,
+            bot_version,
         )
-        
-        print(log_message)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            if body is None:
+                body_text = f"[Not captured, Content-Length: {request.headers.get('content-length', '?')}]"
+            elif body:
+                try:
+                    body_text = body.decode('utf-8')
+                except UnicodeDecodeError:
+                    body_text = f"[Non-UTF-8 data, size: {len(body)} bytes]"
+            else:
+                body_text = "[Empty]"
+            headers = {name: request.headers[name] for name in LOGGED_HEADERS if name in request.headers}
+            logger.debug("Request headers: %s | Request body: %s", headers, body_text)
@@ -0,0 +1,12 @@
+-- Serves GET /api/users/{user_id}/sessions (api/users.py: get_user_sessions).
+--
+-- Partial: only named (non-empty) sessions are listed, so unnamed ones are left out.
+-- (user_id, updated_at DESC) matches the WHERE + ORDER BY, removing the Sort node.
+-- INCLUDE lets Postgres answer the query with an Index Only Scan.
+--
+-- CONCURRENTLY avoids locking chat_sessions against writes while the index builds;
+-- it cannot run inside a transaction block, so apply this file on its own.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_sessions_user_updated
+    ON chat_sessions (user_id, updated_at DESC)
+    INCLUDE (session_id, session_name)
+    WHERE session_name IS NOT NULL;
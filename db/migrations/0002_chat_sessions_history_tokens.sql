@@ -0,0 +1,9 @@
+-- Per-message token counts for chat_sessions.history, kept index-aligned with it
+-- (api/chat.py: handle_chat_message). Counts are local estimates (estimate_tokens,
+-- ~4 characters per token); only new messages are measured and truncation sums
+-- this array.
+--
+-- Existing rows start empty; the handler detects the length mismatch, estimates the
+-- stored history once and backfills the column on its next write.
+ALTER TABLE chat_sessions
+    ADD COLUMN IF NOT EXISTS history_tokens integer[] NOT NULL DEFAULT '{}';
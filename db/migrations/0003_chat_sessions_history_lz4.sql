@@ -0,0 +1,10 @@
+-- Compress chat_sessions.history with lz4 instead of the default pglz (PostgreSQL 14+).
+--
+-- Long histories are TOASTed and decompressed on every read (get_chat_history, and
+-- handle_chat_message whenever its in-process copy is stale); lz4 decompresses several
+-- times faster than pglz at a similar ratio. The in-place jsonb append is unaffected.
+--
+-- Only values written after this runs use lz4; existing rows switch over on their
+-- next history write, so no table rewrite is needed.
+ALTER TABLE chat_sessions
+    ALTER COLUMN history SET COMPRESSION lz4;
@@ -1,49 +1,123 @@
-import json
-from typing import Optional
+import asyncio
+import contextlib
+import logging
+import orjson
 import asyncpg
-from fastapi import FastAPI
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from fastapi import FastAPI, Request
 from contextlib import asynccontextmanager
 
-from core.config import DATABASE_URL
+from core.config import (
+    DATABASE_URL,
+    DB_APPLICATION_NAME,
+    DB_PGBOUNCER,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MIN_SIZE,
+    DB_STATEMENT_CACHE_SIZE,
+    GEMINI_API_KEY,
+    GEMINI_CONFIGURED,
+    LOG_LEVEL,
+)
+from core.logging_config import setup_logging, shutdown_logging
+from services.aws import stop_audio_key_index, warm_audio_key_index
 
-_db_pool: Optional[asyncpg.Pool] = None
+logger = logging.getLogger(__name__)
+
+def _encode_jsonb(value) -> bytes:
+    # Binary jsonb is the JSON text prefixed with a version byte (1).
+    return b'\x01' + orjson.dumps(value)
+
+def _decode_jsonb(data: bytes):
+    return orjson.loads(data[1:])
 
 async def _init_connection(connection):
     """
     A hook to set up the JSONB codec for the database connection.
+    Uses orjson over the binary jsonb wire format.
     """
-    await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+    await connection.set_type_codec(
+        'jsonb',
+        encoder=_encode_jsonb,
+        decoder=_decode_jsonb,
+        schema='pg_catalog',
+        format='binary'
+    )
+
+def _server_settings() -> dict:
+    settings = {'application_name': DB_APPLICATION_NAME}
+    # Short OLTP queries never benefit from JIT compilation. PgBouncer rejects
+    # unknown startup parameters (application_name is one it tracks), so jit is
+    # only sent on direct connections.
+    if not DB_PGBOUNCER:
+        settings['jit'] = 'off'
+    return settings
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     The lifespan manager for the FastAPI application.
-    It connects to the database on startup and closes the connection on shutdown.
+    It connects to the database and the Gemini client on startup and closes the
+    database connection on shutdown.
     """
-    global _db_pool
-    print("Application startup: connecting to database...", flush=True)
+    setup_logging(LOG_LEVEL)
+    logger.info("Application startup: connecting to database...")
     try:
         if DATABASE_URL:
-            _db_pool = await asyncpg.create_pool(DATABASE_URL, init=_init_connection)
-            print("Successfully connected to the database.", flush=True)
+            app.state.db_pool = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=300,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                command_timeout=30,
+                server_settings=_server_settings(),
+                init=_init_connection,
+            )
+            logger.info("Successfully connected to the database.")
         else:
-            print("WARNING: DATABASE_URL not set. Database pool will not be initialized.", flush=True)
-            _db_pool = None
-    except Exception as e:
-        # Add flush=True to ensure this critical error is logged immediately
-        print(f"FATAL: Failed to connect to the database: {e}", flush=True)
-        _db_pool = None
+            logger.warning("DATABASE_URL not set. Database pool will not be initialized.")
+            app.state.db_pool = None
+    except Exception:
+        logger.critical("Failed to connect to the database", exc_info=True)
+        app.state.db_pool = None
     
+    # Configure Gemini once and create the shared async client on this event loop,
+    # so the first chat request doesn't pay for channel setup. genai keeps the client
+    # in its own registry and every cached GenerativeModel picks it up from there.
+    # Without a real key the app still starts; chat requests then fail with a 503.
+    if GEMINI_CONFIGURED:
+        try:
+            genai.configure(api_key=GEMINI_API_KEY)
+            genai_client.get_default_generative_async_client()
+        except Exception:
+            logger.error("Failed to initialize the Gemini client", exc_info=True)
+    else:
+        logger.warning("GEMINI_API_KEY not set or a placeholder. Gemini client will not be initialized.")
+
+    # Index the audio bucket in the background; until it finishes, audio lookups
+    # keep using head_object, so startup doesn't wait on the listing.
+    app.state.audio_index_task = asyncio.create_task(warm_audio_key_index())
+
     yield
+
+    # Don't leave the listing running (or its failure unobserved) past shutdown.
+    stop_audio_key_index()
+    app.state.audio_index_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app.state.audio_index_task
     
-    if _db_pool:
-        print("Application shutdown: closing database connection pool...", flush=True)
-        await _db_pool.close()
-        print("Database connection pool closed.", flush=True)
+    if app.state.db_pool:
+        logger.info("Application shutdown: closing database connection pool...")
+        await app.state.db_pool.close()
+        logger.info("Database connection pool closed.")
+
+    shutdown_logging()
 
-def get_db_pool():
+async def get_db_pool(request: Request):
     """
     A dependency to get the database pool.
     This is used by the API endpoints to interact with the database.
+    Declared async so FastAPI calls it inline instead of dispatching to its threadpool.
     """
-    return _db_pool
+    return request.app.state.db_pool
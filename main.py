@@ -1,29 +1,35 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
 
 # Import routers from the api directory
 from api import personas, chat, users, voices, report
 # Import the lifespan manager from the db directory
-from db.session import lifespan
+from db.session import get_db_pool, lifespan
 # Import the application version from the config
-from core.config import APP_VERSION
+from core.config import APP_VERSION, CORS_ALLOW_ORIGINS
 
 # Initialize the FastAPI app with the lifespan manager and the dynamic version
 app = FastAPI(
     title="AI Chatbox API",
     description="Backend API for an AI Chatbox application with session management.",
     version=APP_VERSION,
-    lifespan=lifespan
+    lifespan=lifespan,
+    # orjson (already used for the jsonb codec) renders response bodies instead of json.dumps
+    default_response_class=ORJSONResponse,
 )
 
 # --- CORS Middleware ---
-# Allows the frontend to communicate with this backend
+# Allows the frontend to communicate with this backend.
+# Explicit methods/headers let Starlette build the preflight headers once instead of
+# echoing the requested ones per request; max_age lets browsers cache preflights.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins for development
+    allow_origins=CORS_ALLOW_ORIGINS,  # "*" unless CORS_ALLOW_ORIGINS is set
     allow_credentials=True,
-    allow_methods=["*"],  # Allows all HTTP methods
-    allow_headers=["*"],  # Allows all headers
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_headers=["authorization", "content-type", "x-request-id"],
+    max_age=7200,
 )
 
 # --- Include Routers ---
@@ -38,3 +44,24 @@ app.include_router(report.router, prefix="/api/report", tags=["Report"])
 @app.get("/", tags=["Root"])
 async def read_root():
     return {"message": f"Welcome to the AI Chatbox API v{APP_VERSION}"}
+
+# Health check for the load balancer: verifies the database round-trip and reports
+# pool usage, so connection starvation shows up before requests start queueing.
+@app.get("/health", tags=["Root"])
+async def health(db_pool=Depends(get_db_pool)):
+    if not db_pool:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "database": "not configured"})
+    try:
+        async with db_pool.acquire(timeout=5) as connection:
+            await connection.fetchval("SELECT 1")
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "database": str(e)})
+    return {
+        "status": "ok",
+        "pool": {
+            "size": db_pool.get_size(),
+            "idle": db_pool.get_idle_size(),
+            "min_size": db_pool.get_min_size(),
+            "max_size": db_pool.get_max_size(),
+        },
+    }
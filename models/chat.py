@@ -29,14 +29,14 @@ class StartChatSessionRequest(BaseModel):
     bot_version: Optional[str] = None
 
 class StartChatSessionResponse(BaseModel):
-    session_id: str
+    session_id: uuid.UUID
     session_name: Optional[str] = None
     persona_id: Optional[int] = None
     bot_version: Optional[str] = None
     history: List[ChatMessage] = Field(default_factory=list)
 
 class ChatSessionResponse(BaseModel):
-    session_id: str
+    session_id: uuid.UUID
     session_name: Optional[str] = None
     persona_id: Optional[int] = None
     bot_version: Optional[str] = None
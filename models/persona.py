@@ -1,6 +1,6 @@
 from typing import Optional
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 class Persona(BaseModel):
     prompt_id: Optional[int] = None
@@ -22,5 +22,4 @@ class Persona(BaseModel):
     additional_notes: Optional[str] = None
     created_at: Optional[datetime] = None
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
@@ -1,6 +1,16 @@
+import asyncio
+import base64
 import hashlib
+import hmac
+import logging
 import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from urllib.parse import parse_qsl, quote
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from core.config import (
@@ -10,6 +20,8 @@ from core.config import (
     S3_BUCKET_NAME,
 )
 
+logger = logging.getLogger(__name__)
+
 # Initialize boto3 clients if credentials are provided
 if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
     session = boto3.Session(
@@ -17,17 +29,50 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
         region_name=AWS_REGION,
     )
-    polly_client = session.client("polly")
-    s3_client = session.client("s3")
+    # Audio calls run concurrently in worker threads; a larger connection pool keeps
+    # them on warm keep-alive connections instead of queueing for one of the default 10.
+    client_config = Config(
+        max_pool_connections=50,
+        retries={"max_attempts": 3, "mode": "standard"},
+        tcp_keepalive=True,
+    )
+    polly_client = session.client("polly", config=client_config)
+    s3_client = session.client("s3", config=client_config)
 else:
     polly_client = None
     s3_client = None
 
+PRESIGNED_URL_EXPIRES_IN = 3600  # URLs expire in 1 hour
+# A cached audio URL is handed out only while it has at least 5 minutes left to live.
+AUDIO_URL_CACHE_TTL_SECONDS = PRESIGNED_URL_EXPIRES_IN - 300
+AUDIO_URL_CACHE_MAX_SIZE = 10_000
+
+# filename -> (monotonic deadline, pre-signed URL) for audio known to be in S3.
+_audio_url_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+# Keys known to exist in the bucket: one listing at startup plus this process's own
+# uploads and HEAD hits. While the index holds the whole bucket, a key missing from it
+# goes straight to Polly; otherwise (listing not finished, not permitted, or the bucket
+# outgrew the cap) a missing key is checked with HEAD. Capped so per-worker memory and
+# startup listing stay bounded as the bucket grows; least recently used keys go first.
+AUDIO_KEY_INDEX_MAX_SIZE = 20_000
+_known_audio_keys: "OrderedDict[str, None]" = OrderedDict()
+_known_audio_keys_complete = False
+_audio_key_evictions = 0
+_audio_index_stop = threading.Event()
+
+# filename -> task resolving its URL, while a cache miss for it is being handled.
+_inflight_audio: "dict[str, asyncio.Task]" = {}
+
 def generate_audio_filename(text: str, voice_id: str) -> str:
     """Creates a unique, deterministic filename based on text and voice."""
-    clean_text = text.strip()
-    sha256 = hashlib.sha256((clean_text + voice_id).encode("utf-8")).hexdigest()
-    return f"{sha256}.mp3"
+    # Feeding the parts separately hashes the same bytes as text + voice_id without
+    # building the concatenated string. Keys must stay SHA-256 of that exact input:
+    # stored histories are re-signed from the filename alone. hashlib uses OpenSSL's
+    # SHA-256, which picks the SHA-NI/ARMv8 instructions at runtime when the CPU has them.
+    h = hashlib.sha256(text.strip().encode("utf-8"), usedforsecurity=False)
+    h.update(voice_id.encode("utf-8"))
+    return f"{h.hexdigest()}.mp3"
 
 def get_presigned_url(file_name: str) -> str:
     """Generates a pre-signed URL to access a private S3 object."""
@@ -37,21 +82,155 @@ def get_presigned_url(file_name: str) -> str:
         url = s3_client.generate_presigned_url(
             'get_object',
             Params={'Bucket': S3_BUCKET_NAME, 'Key': file_name},
-            ExpiresIn=3600  # URL expires in 1 hour
+            ExpiresIn=PRESIGNED_URL_EXPIRES_IN
         )
         return url
     except ClientError as e:
-        print(f"Error generating pre-signed URL: {e}")
+        logger.error("Error generating pre-signed URL: %s", e)
         return None
 
+def _quote_key(file_name: str) -> str:
+    return quote(file_name, safe='/~')
+
+def get_presigned_urls(file_names: List[str]) -> List[Optional[str]]:
+    """
+    Generates pre-signed URLs for several S3 objects in one call.
+
+    The first URL is produced by boto3 and serves as the reference: the rest reuse its
+    host and expiry and are signed locally with a single precomputed HMAC key, using the
+    same S3 query-string auth boto3 emits for this client. If the local signature doesn't
+    reproduce boto3's for the first file (e.g. SigV4 gets configured), every URL falls
+    back to boto3.
+    """
+    if not file_names:
+        return []
+    first_url = get_presigned_url(file_names[0])
+    if not first_url or len(file_names) == 1:
+        return [first_url] + [get_presigned_url(file_name) for file_name in file_names[1:]]
+
+    base_url, _, query = first_url.partition('?')
+    params = dict(parse_qsl(query))
+    expires = params.get('Expires')
+    hmac_key = hmac.new(AWS_SECRET_ACCESS_KEY.encode('utf-8'), digestmod=hashlib.sha1)
+
+    def sign(file_name: str) -> str:
+        string_to_sign = f"GET\n\n\n{expires}\n/{S3_BUCKET_NAME}/{_quote_key(file_name)}"
+        mac = hmac_key.copy()
+        mac.update(string_to_sign.encode('utf-8'))
+        return base64.b64encode(mac.digest()).decode('utf-8')
+
+    first_key_path = '/' + _quote_key(file_names[0])
+    if (
+        expires is None
+        or params.get('Signature') != sign(file_names[0])
+        or not base_url.endswith(first_key_path)
+    ):
+        return [first_url] + [get_presigned_url(file_name) for file_name in file_names[1:]]
+
+    url_prefix = base_url[:-len(first_key_path)]
+    access_key = quote(params['AWSAccessKeyId'], safe='-_.~')
+    return [first_url] + [
+        f"{url_prefix}/{_quote_key(file_name)}?AWSAccessKeyId={access_key}"
+        f"&Signature={quote(sign(file_name), safe='-_.~')}&Expires={expires}"
+        for file_name in file_names[1:]
+    ]
+
+# Finds `volume="..."` within a `<prosody ...>` tag; compiled once at import.
+_PROSODY_VOLUME_RE = re.compile(r'(<prosody[^>]*)\s+volume="[^"]*"([^>]*>)', re.IGNORECASE)
+_VOLUME_ATTR_RE = re.compile('volume=', re.IGNORECASE)
+
 def sanitize_ssml(ssml_text: str) -> str:
     """
     Removes unsupported attributes from SSML tags to prevent Polly errors.
     Specifically targets the 'volume' attribute in the <prosody> tag for Neural voices.
     """
-    # This regex finds `volume="..."` within a `<prosody ...>` tag and removes it.
-    sanitized = re.sub(r'(<prosody[^>]*)\s+volume="[^"]*"([^>]*>)', r'\1\2', ssml_text, flags=re.IGNORECASE)
-    return sanitized
+    # Most SSML never sets volume: a case-insensitive literal search, which copies
+    # nothing, skips the substitution pattern entirely.
+    if not _VOLUME_ATTR_RE.search(ssml_text):
+        return ssml_text
+    return _PROSODY_VOLUME_RE.sub(r'\1\2', ssml_text)
+
+def _evict_audio_keys() -> None:
+    global _known_audio_keys_complete, _audio_key_evictions
+    while len(_known_audio_keys) > AUDIO_KEY_INDEX_MAX_SIZE:
+        _known_audio_keys.popitem(last=False)
+        _audio_key_evictions += 1
+        # An evicted key is no longer proof of absence; go back to HEAD for misses.
+        _known_audio_keys_complete = False
+
+def _remember_audio_key(key: str) -> None:
+    _known_audio_keys[key] = None
+    _known_audio_keys.move_to_end(key)
+    _evict_audio_keys()
+
+def _list_audio_keys() -> Optional[List[str]]:
+    """
+    Blocking bucket listing; run in a worker thread. Only collects keys, stopping once
+    there are more than the index can hold. Returns None if asked to stop.
+    """
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET_NAME):
+        if _audio_index_stop.is_set():
+            return None
+        keys.extend(obj['Key'] for obj in page.get('Contents', ()))
+        if len(keys) > AUDIO_KEY_INDEX_MAX_SIZE:
+            break
+    return keys
+
+async def warm_audio_key_index() -> None:
+    """Lists the bucket once so audio existence checks can be answered from memory."""
+    global _known_audio_keys_complete
+    if not s3_client or not S3_BUCKET_NAME:
+        return
+    _audio_index_stop.clear()
+    evictions_before = _audio_key_evictions
+    try:
+        keys = await asyncio.to_thread(_list_audio_keys)
+    except Exception:
+        logger.warning("Could not list S3 bucket, falling back to head_object checks.", exc_info=True)
+        return
+    if keys is None:
+        return
+    # Merged here on the event loop, like every other change to the index, so request
+    # handlers never see it half-updated.
+    _known_audio_keys.update(dict.fromkeys(keys))
+    _evict_audio_keys()
+    if len(keys) > AUDIO_KEY_INDEX_MAX_SIZE:
+        logger.info(
+            "Audio bucket has more than %d files; indexing stopped, misses use head_object.",
+            AUDIO_KEY_INDEX_MAX_SIZE,
+        )
+        return
+    # Keys evicted while the listing ran may be missing from it; stay on HEAD then.
+    if _audio_key_evictions == evictions_before:
+        _known_audio_keys_complete = True
+        logger.info("Indexed %d audio files in S3.", len(_known_audio_keys))
+
+def stop_audio_key_index() -> None:
+    """Asks a running bucket listing to stop at its next page."""
+    _audio_index_stop.set()
+
+def _synthesize_and_upload(filename: str, text: str, voice_id: str, text_type: str) -> None:
+    """Blocking Polly synthesis + S3 upload; run in a worker thread."""
+    response = polly_client.synthesize_speech(
+        Text=text,
+        TextType=text_type,
+        OutputFormat="mp3",
+        VoiceId=voice_id,
+        Engine="neural"
+    )
+    s3_client.put_object(
+        Bucket=S3_BUCKET_NAME,
+        Key=filename,
+        Body=response["AudioStream"].read(),
+        ContentType="audio/mpeg"
+    )
+
+def _cache_audio_url(file_name: str, url: str, signed_at: float) -> None:
+    _audio_url_cache[file_name] = (signed_at + AUDIO_URL_CACHE_TTL_SECONDS, url)
+    _audio_url_cache.move_to_end(file_name)
+    if len(_audio_url_cache) > AUDIO_URL_CACHE_MAX_SIZE:
+        _audio_url_cache.popitem(last=False)
 
 async def get_or_create_audio_url(text: str, voice_id: str, text_type: str = 'text') -> str:
     """
@@ -59,7 +238,7 @@ async def get_or_create_audio_url(text: str, voice_id: str, text_type: str = 'te
     Accepts 'text' or 'ssml' as text_type.
     """
     if not all([polly_client, s3_client, S3_BUCKET_NAME]):
-        print("AWS service is not configured. Skipping audio generation.")
+        logger.debug("AWS service is not configured. Skipping audio generation.")
         return None
 
     clean_text = text.strip()
@@ -68,39 +247,65 @@ async def get_or_create_audio_url(text: str, voice_id: str, text_type: str = 'te
 
     filename = generate_audio_filename(clean_text, voice_id)
 
-    try:
-        s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=filename)
-        print(f"Cache HIT: Found audio file {filename} in S3.")
-    except ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            print(f"Cache MISS: File {filename} not in S3. Generating with Polly...")
-            try:
-                # Sanitize the SSML before sending it to Polly
-                text_to_synthesize = clean_text
-                if text_type == 'ssml':
-                    text_to_synthesize = sanitize_ssml(clean_text)
-                    print(f"Sanitized SSML for Polly: {text_to_synthesize}")
-
-                response = polly_client.synthesize_speech(
-                    Text=text_to_synthesize,
-                    TextType=text_type,
-                    OutputFormat="mp3",
-                    VoiceId=voice_id,
-                    Engine="neural"
-                )
-                
-                s3_client.put_object(
-                    Bucket=S3_BUCKET_NAME,
-                    Key=filename,
-                    Body=response["AudioStream"].read(),
-                    ContentType="audio/mpeg"
-                )
-                print(f"SUCCESS: Uploaded {filename} to S3.")
-            except Exception as polly_error:
-                print(f"ERROR: Failed to generate or upload audio: {polly_error}")
+    # Repeat requests for the same audio skip both the S3 HEAD and the signing.
+    cached = _audio_url_cache.get(filename)
+    if cached and cached[0] > time.monotonic():
+        _audio_url_cache.move_to_end(filename)
+        return cached[1]
+
+    # Concurrent misses for the same file share one lookup/synthesis instead of each
+    # calling Polly and uploading the same object. shield() keeps a cancelled caller
+    # from cancelling the work the others are waiting on.
+    task = _inflight_audio.get(filename)
+    if task is None:
+        task = asyncio.create_task(_resolve_audio_url(filename, clean_text, voice_id, text_type))
+        _inflight_audio[filename] = task
+        task.add_done_callback(lambda _: _inflight_audio.pop(filename, None))
+    return await asyncio.shield(task)
+
+async def _resolve_audio_url(filename: str, clean_text: str, voice_id: str, text_type: str) -> Optional[str]:
+    """Finds or synthesizes the audio file in S3 and returns a fresh pre-signed URL."""
+    if filename in _known_audio_keys:
+        logger.debug("Cache HIT: Found audio file %s in S3.", filename)
+        _known_audio_keys.move_to_end(filename)
+        exists = True
+    elif _known_audio_keys_complete:
+        # Not in the startup listing nor uploaded since; skip the HEAD round trip.
+        exists = False
+    else:
+        try:
+            # boto3 is blocking; network calls go to a worker thread so the event loop
+            # keeps serving other requests during the S3/Polly round trips.
+            await asyncio.to_thread(s3_client.head_object, Bucket=S3_BUCKET_NAME, Key=filename)
+            logger.debug("Cache HIT: Found audio file %s in S3.", filename)
+            _remember_audio_key(filename)
+            exists = True
+        except ClientError as e:
+            # HEAD responses carry no error body, so S3 never raises NoSuchKey here;
+            # a missing key is recognised by its HTTP status.
+            if e.response['ResponseMetadata']['HTTPStatusCode'] != 404:
+                logger.error("An S3 error occurred on head_object: %s", e)
                 return None
-        else:
-            print(f"ERROR: An S3 error occurred on head_object: {e}")
+            exists = False
+
+    if not exists:
+        logger.info("Cache MISS: File %s not in S3. Generating with Polly...", filename)
+        try:
+            # Sanitize the SSML before sending it to Polly
+            text_to_synthesize = clean_text
+            if text_type == 'ssml':
+                text_to_synthesize = sanitize_ssml(clean_text)
+                logger.debug("Sanitized SSML for Polly: %s", text_to_synthesize)
+
+            await asyncio.to_thread(_synthesize_and_upload, filename, text_to_synthesize, voice_id, text_type)
+            _remember_audio_key(filename)
+            logger.info("Uploaded %s to S3.", filename)
+        except Exception:
+            logger.exception("Failed to generate or upload audio %s", filename)
             return None
-            
-    return get_presigned_url(filename)
+
+    signed_at = time.monotonic()
+    url = get_presigned_url(filename)
+    if url:
+        _cache_audio_url(filename, url, signed_at)
+    return url